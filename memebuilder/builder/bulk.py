@@ -0,0 +1,183 @@
+import cStringIO
+import os
+import tarfile
+import time
+import zipfile
+from os import path
+
+from django.conf import settings
+
+from . import lazy
+from . import views
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Image = lazy.module('PIL.Image')
+ImageColor = lazy.module('PIL.ImageColor')
+ImageDraw = lazy.module('PIL.ImageDraw')
+ImageFont = lazy.module('PIL.ImageFont')
+
+
+# The caption form's fields for each location, and the offset used for each.
+locations = (('top', 'talign', 10), ('middle', 'malign', 0),
+             ('bottom', 'balign', 10))
+
+
+class Compositor(object):
+    """Captions many images with one font, size and color.
+
+    Each distinct (text, location, alignment, width) is wrapped once, and each
+    distinct line is rasterized into a glyph mask once, however many images it
+    is drawn on. Masks are blended onto images with NumPy when it is installed,
+    and with Image.paste otherwise.
+
+    """
+    def __init__(self, font, size, color):
+        self.color = color
+        self.font = ImageFont.truetype('%s%s%s' % (settings.FONT_DIR, font,
+                                                   settings.FONT_TYPE),
+                                       size)
+        self.arrays = {}
+        self.layouts = {}
+        self.masks = {}
+
+    def caption(self, im, params):
+        """Returns a copy of im captioned using the caption form's fields in
+        params.
+
+        im must be in mode 'L', 'RGB' or 'RGBA'.
+
+        """
+        fill = ImageColor.getcolor(self.color, im.mode)
+        if numpy is None:
+            im = im.copy()
+            for line, pos in self.layout(im.size, params):
+                im.paste(fill, pos, self.mask(line))
+            return im
+        arr = numpy.array(im)
+        fill = numpy.array(fill, dtype=numpy.uint16)
+        for line, (x, y) in self.layout(im.size, params):
+            if line not in self.arrays:
+                self.arrays[line] = numpy.asarray(self.mask(line))
+            blend(arr, self.arrays[line], x, y, fill)
+        return Image.fromarray(arr, im.mode)
+
+    def layout(self, im_size, params):
+        """Returns a list of (line, position) tuples for the text in params on
+        an image of im_size.
+
+        """
+        lines = []
+        for loc, align_field, offset in locations:
+            if not params.get(loc):
+                continue
+            align = params.get(align_field, 'left')
+            key = (params[loc], loc, align, im_size[0])
+            if key not in self.layouts:
+                self.layouts[key] = self._wrap(im_size[0], params[loc], loc,
+                                               align, offset)
+            # Layouts are computed for an image with no height. Moving them
+            # down by the distance wrap(...) measures from gives the positions
+            # on this image.
+            if loc == 'top':
+                shift = 0
+            elif loc == 'middle':
+                shift = im_size[1] / 2
+            else:
+                shift = im_size[1]
+            for line, (x, y) in self.layouts[key]:
+                lines.append((line, (int(x), int(y + shift))))
+        return lines
+
+    def mask(self, line):
+        """Returns the glyph mask for a line of text."""
+        if line not in self.masks:
+            mask = Image.new('L', self.font.getsize(line), 0)
+            ImageDraw.Draw(mask).text((0, 0), line, font=self.font, fill=255)
+            self.masks[line] = mask
+        return self.masks[line]
+
+    def _wrap(self, width, text, loc, align, offset):
+        layout = views.wrap((width, 0), self.font, text, loc, align, offset)
+        if loc == 'middle':
+            layout = views.balance(layout)
+        return zip(*layout)
+
+
+def blend(arr, mask, x, y, fill):
+    """Blends fill into arr at (x, y), weighted by mask.
+
+    Parts of the mask that fall outside of arr are ignored.
+
+    """
+    x0, y0 = max(x, 0), max(y, 0)
+    x1 = min(x + mask.shape[1], arr.shape[1])
+    y1 = min(y + mask.shape[0], arr.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    alpha = mask[y0 - y:y1 - y, x0 - x:x1 - x].astype(numpy.uint16)
+    region = arr[y0:y1, x0:x1]
+    if region.ndim == 3:
+        alpha = alpha[:, :, numpy.newaxis]
+    region[...] = (region * (255 - alpha) + fill * alpha + 127) // 255
+
+
+def composite(fns, captions, font, size, color, dest):
+    """Captions each template in fns with each caption in captions.
+
+    captions is a list of dicts using the caption form's fields (top, talign,
+    middle, malign, bottom and balign). Results are written to dest, which is
+    either a directory or an archive ending in .zip, .tar, .tar.gz or .tar.bz2,
+    and are named after the template and the caption's index in captions
+    (e.g., business_cat-0.jpg). Returns the list of names written.
+
+    """
+    compositor = Compositor(font, size, color)
+    out = Destination(dest)
+    names = []
+    try:
+        for fn in fns:
+            im, format_ = views.open_template(fn)[:2]
+            base = im.convert(im.mode if im.mode in ('L', 'RGBA') else 'RGB')
+            stem, ext = path.splitext(fn)
+            for i, params in enumerate(captions):
+                data, format_ = views.encode(compositor.caption(base, params),
+                                             format_)
+                names.append('%s-%d%s' % (stem, i, ext))
+                out.write(names[-1], data)
+    finally:
+        out.close()
+    return names
+
+
+class Destination(object):
+    """Writes files to a directory, or to a zip or tar archive."""
+    def __init__(self, dest):
+        self.archive = None
+        self.dest = dest
+        if dest.endswith('.zip'):
+            self.archive = zipfile.ZipFile(dest, 'w', zipfile.ZIP_STORED)
+        elif dest.endswith(('.tar', '.tar.gz', '.tar.bz2')):
+            self.archive = tarfile.open(dest,
+                                        'w:%s' % dest.rsplit('.tar', 1)[1][1:])
+        elif not path.isdir(dest):
+            os.makedirs(dest)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+    def write(self, name, data):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, data)
+        elif self.archive is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, cStringIO.StringIO(data))
+        else:
+            with open(path.join(self.dest, name), 'wb') as f:
+                f.write(data)
@@ -0,0 +1,194 @@
+import errno
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from os import path
+
+from django.conf import settings
+
+
+prune_every = 100
+
+_calls = {}
+_lock = threading.Lock()
+_writes = [0]
+
+
+class _Call(object):
+    """A render in progress that other threads can wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.result = None
+
+
+def key_for(*parts):
+    """Returns a render key for parts, suitable for use as a filename.
+
+    >>> key_for('thumbnail', 'business_cat.jpg', None, None)
+    '795f8d6a7c652ba0aa9db14f1b256e8bec1d88f0'
+
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def do(key, render):
+    """Calls render() once for all concurrent callers sharing key.
+
+    The first caller in a process renders; other threads wait for, and share,
+    its result (or its exception). If settings.COALESCE_DIR is set, the
+    renderer also holds a lock on a file in that directory, so callers in other
+    processes wait for it and read its result from disk instead of rendering.
+    Results are only written to disk when another process is waiting for them.
+
+    render must return a (data, format) tuple of strings.
+
+    """
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+    try:
+        if settings.COALESCE_DIR:
+            call.result = _do_shared(key, render)
+        else:
+            call.result = render()
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
+    return call.result
+
+
+def prune(max_age=None):
+    """Removes coalescing files older than max_age seconds.
+
+    flock(...) doesn't change a lock file's mtime, so an old lock file may
+    still be held. Lock files are only removed while prune holds them, and
+    callers that opened one before it was removed lock its replacement instead.
+
+    """
+    if max_age is None:
+        max_age = settings.COALESCE_TTL
+    cutoff = time.time() - max_age
+    for fn in os.listdir(settings.COALESCE_DIR):
+        fp = path.join(settings.COALESCE_DIR, fn)
+        try:
+            if os.stat(fp).st_mtime >= cutoff:
+                continue
+            if not fn.endswith('.lock'):
+                os.remove(fp)
+                continue
+            fd = os.open(fp, os.O_RDWR)
+            try:
+                if _try_lock(fd) and _is_current(fd, fp):
+                    os.remove(fp)
+            finally:
+                os.close(fd)
+        except OSError:
+            # Another process pruned it first.
+            pass
+
+
+def _do_shared(key, render):
+    # Renders under an exclusive lock on <key>.lock, or waits for the process
+    # holding it and reuses the result it left in <key>.out. Waiters create
+    # <key>.wait so the renderer knows to leave its result; otherwise, it
+    # removes <key>.lock before releasing it.
+    _makedirs(settings.COALESCE_DIR)
+    base = path.join(settings.COALESCE_DIR, key)
+    while True:
+        fd = os.open(base + '.lock', os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            leader = _try_lock(fd)
+            if not leader:
+                open(base + '.wait', 'a').close()
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            if not _is_current(fd, base + '.lock'):
+                # prune() removed the lock file after it was opened.
+                continue
+            if not leader:
+                result = _read(base + '.out')
+                if result is not None:
+                    return result
+                # The other process failed; render without holding anyone up.
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return render()
+            result = render()
+            if not path.exists(base + '.wait'):
+                # Nobody is waiting, so leave nothing behind. Callers that
+                # opened the lock file since then lock its replacement.
+                os.remove(base + '.lock')
+                return result
+            _write(base + '.out', result)
+            try:
+                os.remove(base + '.wait')
+            except OSError:
+                pass
+            break
+        finally:
+            os.close(fd)
+    _writes[0] += 1
+    if _writes[0] % prune_every == 0:
+        prune()
+    return result
+
+
+def _is_current(fd, fp):
+    # Returns whether fd is still open on the file at fp.
+    try:
+        return path.samestat(os.fstat(fd), os.stat(fp))
+    except OSError:
+        return False
+
+
+def _makedirs(dn):
+    try:
+        os.makedirs(dn)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _read(fp):
+    # Returns the (data, format) stored in fp, or None if it is missing or too
+    # old to trust.
+    try:
+        if os.stat(fp).st_mtime < time.time() - settings.COALESCE_TTL:
+            return None
+        with open(fp, 'rb') as f:
+            format_, data = f.read().split('\n', 1)
+    except (IOError, OSError, ValueError):
+        return None
+    return data, format_
+
+
+def _try_lock(fd):
+    # Returns whether an exclusive lock on fd was taken without waiting.
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno not in (errno.EACCES, errno.EAGAIN):
+            raise
+        return False
+    return True
+
+
+def _write(fp, (data, format_)):
+    # Writes to a temporary file first so readers never see a partial result.
+    tmp = '%s.%d.tmp' % (fp, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write('%s\n' % format_)
+        f.write(data)
+    os.rename(tmp, fp)
@@ -0,0 +1,206 @@
+import cStringIO
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import time
+from os import path
+
+from django.conf import settings
+
+from . import lazy
+from . import pyramid
+from . import views
+
+Image = lazy.module('PIL.Image')
+ImageOps = lazy.module('PIL.ImageOps')
+
+
+catalog_name = '.catalog.json'
+
+
+def ingest(sources, jobs=None):
+    """Normalizes candidate images and adds them to the templates.
+
+    Each source is decoded, turned upright using its EXIF orientation,
+    converted to RGB (RGBA if it has transparency), scaled down to
+    settings.INGEST_MAX_EDGE and re-encoded without metadata, as PNG if it has
+    transparency or no more than 256 colors and as JPEG otherwise. Candidates
+    whose pixels match an existing template, or an earlier candidate, are
+    skipped. Existing templates are prepared the same way before they are
+    compared, so copies of templates larger than settings.INGEST_MAX_EDGE are
+    found too. Each new template gets its pyramid and an entry in the catalog,
+    which maps content hashes to templates.
+
+    Work is spread across jobs processes (by default, one per CPU). Returns a
+    dict summarizing what was done, including the bytes and decode time of the
+    candidates before and after normalizing.
+
+    """
+    pool = multiprocessing.Pool(jobs)
+    try:
+        max_edge = settings.INGEST_MAX_EDGE
+        templates = set(fn for name, fn in views.list_templates())
+        # Hashes depend on the size templates were scaled down to, so entries
+        # made with another INGEST_MAX_EDGE are hashed again.
+        catalog = dict((digest, entry)
+                       for digest, entry in load_catalog().iteritems()
+                       if entry['name'] in templates and
+                          entry.get('max_edge') == max_edge)
+        known = set(entry['name'] for entry in catalog.itervalues())
+        unknown = sorted(templates - known)
+        for entry in pool.map(_hash_template, unknown):
+            if entry is not None:
+                fn, digest, size = entry
+                catalog[digest] = {'max_edge': max_edge, 'name': fn,
+                                   'size': size}
+
+        summary = {'added': [], 'bytes_after': 0, 'bytes_before': 0,
+                   'decode_after': 0.0, 'decode_before': 0.0,
+                   'duplicates': [], 'failed': []}
+        added = []
+        for result in pool.map(normalize, sorted(sources)):
+            if 'error' in result:
+                summary['failed'].append((result['source'], result['error']))
+                continue
+            if result['hash'] in catalog:
+                summary['duplicates'].append(
+                    (result['source'], catalog[result['hash']]['name']))
+                continue
+            fn = _save(result)
+            catalog[result['hash']] = {'bytes': len(result['data']),
+                                       'max_edge': max_edge, 'name': fn,
+                                       'size': result['size'],
+                                       'source': path.basename(
+                                           result['source'])}
+            added.append(path.join(views.templates, fn))
+            summary['added'].append((result['source'], fn))
+            for key in ('bytes_after', 'bytes_before', 'decode_after',
+                        'decode_before'):
+                summary[key] += result[key]
+        save_catalog(catalog)
+
+        if settings.PYRAMID_DIR:
+            pool.map(_build_pyramid, added)
+    finally:
+        pool.close()
+        pool.join()
+    return summary
+
+
+def load_catalog():
+    """Returns the catalog of templates, keyed by content hash."""
+    try:
+        with open(path.join(views.templates, catalog_name)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def normalize(source):
+    """Decodes and re-encodes a candidate image.
+
+    Returns a dict holding the encoded data and its format, extension, size
+    and content hash, along with the bytes and decode time of the source and
+    the result. If source can't be decoded or converted (e.g., it is too large
+    for PIL to open safely), returns a dict holding an error instead.
+
+    """
+    try:
+        return _normalize(source)
+    except Exception as e:
+        # Fail this candidate rather than every candidate in the pool.
+        return {'error': str(e), 'source': source}
+
+
+def content_hash(im):
+    """Returns a hash of an image's mode, size and pixels."""
+    digest = hashlib.sha1('%s %d %d\n' % (im.mode, im.size[0], im.size[1]))
+    digest.update(im.tobytes())
+    return digest.hexdigest()
+
+
+def save_catalog(catalog):
+    """Saves the catalog of templates."""
+    fp = path.join(views.templates, catalog_name)
+    with open(fp + '.tmp', 'w') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.rename(fp + '.tmp', fp)
+
+
+def _build_pyramid(fp):
+    pyramid.build(fp)
+
+
+def _normalize(source):
+    start = time.time()
+    im = Image.open(source)
+    im.load()
+    decode_before = time.time() - start
+
+    im = _prepare(im)
+    out = cStringIO.StringIO()
+    if im.mode == 'RGBA' or im.getcolors(256) is not None:
+        format_, ext = 'PNG', '.png'
+        im.save(out, format_, optimize=True)
+    else:
+        format_, ext = 'JPEG', '.jpg'
+        im.save(out, format_, quality=settings.INGEST_JPEG_QUALITY,
+                optimize=True)
+    data = out.getvalue()
+
+    start = time.time()
+    Image.open(cStringIO.StringIO(data)).load()
+    decode_after = time.time() - start
+
+    return {'bytes_after': len(data), 'bytes_before': path.getsize(source),
+            'data': data, 'decode_after': decode_after,
+            'decode_before': decode_before, 'ext': ext, 'format': format_,
+            'hash': content_hash(im), 'size': im.size, 'source': source}
+
+
+def _hash_template(fn):
+    # Returns (fn, hash, size) for a template missing from the catalog, or None
+    # if it can't be decoded or converted. The hash is of the template prepared
+    # as a candidate would be, so it matches copies of the template.
+    try:
+        im = Image.open(path.join(views.templates, fn))
+        size = im.size
+        im = _prepare(im)
+    except Exception:
+        return None
+    return fn, content_hash(im), size
+
+
+def _prepare(im):
+    # Turns im upright using its EXIF orientation, converts it to RGB (RGBA if
+    # it has transparency) and scales it down to settings.INGEST_MAX_EDGE.
+    im = ImageOps.exif_transpose(im)
+    if im.mode in ('LA', 'RGBA') or 'transparency' in im.info:
+        im = im.convert('RGBA')
+    else:
+        im = im.convert('RGB')
+    # Some encoders save metadata, such as EXIF, left in info.
+    im.info = {}
+    max_edge = settings.INGEST_MAX_EDGE
+    if max(im.size) > max_edge:
+        im.thumbnail((max_edge, max_edge), Image.ANTIALIAS)
+    return im
+
+
+def _save(result):
+    # Writes a normalized image to the templates under a name the URLs accept,
+    # returning the name. Hidden temporary files are skipped by builder.watch.
+    stem = re.sub(r'\W+', '_', path.splitext(path.basename(
+        result['source']))[0]).strip('_').lower() or 'template'
+    fn = stem + result['ext']
+    i = 1
+    while path.exists(path.join(views.templates, fn)):
+        i += 1
+        fn = '%s_%d%s' % (stem, i, result['ext'])
+    tmp = path.join(views.templates, '.%s.tmp' % fn)
+    with open(tmp, 'wb') as f:
+        f.write(result['data'])
+    os.rename(tmp, path.join(views.templates, fn))
+    return fn
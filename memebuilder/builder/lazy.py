@@ -0,0 +1,16 @@
+from django.utils import functional
+from django.utils import importlib
+
+
+def module(name):
+    """Returns a proxy that imports the module name the first time it is used.
+
+    Importing PIL and its plugins is a noticeable part of a new process's first
+    request, so modules that aren't needed to start up are imported this way.
+
+    >>> json = module('json')
+    >>> json.dumps([1])
+    '[1]'
+
+    """
+    return functional.SimpleLazyObject(lambda: importlib.import_module(name))
@@ -0,0 +1,19 @@
+from os import path
+
+from django.conf import settings
+from django.core.management import base
+
+from builder import pyramid
+from builder import views
+
+
+class Command(base.NoArgsCommand):
+    help = ('Builds any missing resize pyramid levels for the templates. Run '
+            'this after adding templates.')
+
+    def handle_noargs(self, **options):
+        if not settings.PYRAMID_DIR:
+            raise base.CommandError('PYRAMID_DIR is not set.')
+        for name, fn in views.list_templates():
+            size, levels = pyramid.build(path.join(views.templates, fn))
+            self.stdout.write('%s: %d levels\n' % (fn, len(levels)))
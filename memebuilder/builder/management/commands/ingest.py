@@ -0,0 +1,39 @@
+import os
+from optparse import make_option
+from os import path
+
+from django.core.management import base
+
+from builder import ingest
+
+
+class Command(base.BaseCommand):
+    args = '<directory>'
+    help = ('Normalizes the images in a directory and adds them to the '
+            'templates, skipping duplicates.')
+    option_list = base.BaseCommand.option_list + (
+        make_option('--jobs', '-j', type='int', dest='jobs', default=None,
+                    help='The number of processes to use. Defaults to the '
+                         'number of CPUs.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not path.isdir(args[0]):
+            raise base.CommandError('Expected a directory of images.')
+        sources = [path.join(args[0], fn) for fn in os.listdir(args[0])
+                   if not fn.startswith('.') and
+                      path.isfile(path.join(args[0], fn))]
+        summary = ingest.ingest(sources, options['jobs'])
+        for source, fn in summary['added']:
+            self.stdout.write('Added %s as %s\n' % (source, fn))
+        for source, fn in summary['duplicates']:
+            self.stdout.write('Skipped %s, a duplicate of %s\n' % (source, fn))
+        for source, error in summary['failed']:
+            self.stderr.write('Failed to read %s: %s\n' % (source, error))
+        self.stdout.write(
+            'Added %d templates: %d bytes reduced to %d, %.3fs of decoding '
+            'reduced to %.3fs.\n' % (len(summary['added']),
+                                     summary['bytes_before'],
+                                     summary['bytes_after'],
+                                     summary['decode_before'],
+                                     summary['decode_after']))
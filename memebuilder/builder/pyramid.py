@@ -0,0 +1,173 @@
+import fcntl
+import logging
+import os
+import Queue
+import threading
+from os import path
+
+from django.conf import settings
+
+from . import lazy
+from . import store
+
+Image = lazy.module('PIL.Image')
+
+
+# Levels are halved until their longest edge is no more than min_edge, the
+# longest edge of views.thumbnail_size.
+logger = logging.getLogger(__name__)
+min_edge = 128
+
+_lock = threading.Lock()
+_pid = None
+_pyramids = {}
+_queue = None
+_thread = None
+
+
+def build(fp, st=None):
+    """Builds any missing levels of the pyramid for the template at fp.
+
+    Each level halves the size of the one above it, down to thumbnail size, and
+    is saved as a raw file in settings.PYRAMID_DIR that every process can map.
+    Only missing levels are resized, each from the level above it. Returns a
+    (size, levels) tuple, where size is the template's size and levels is a
+    list of (size, path) tuples, largest first. Templates that can't be stored
+    (see store.storable) have no levels. st is fp's os.stat result, if the
+    caller already has it.
+
+    """
+    if st is None:
+        st = os.stat(fp)
+    version = '%s.%d.%d' % (path.basename(fp), int(st.st_mtime), st.st_size)
+    with _lock:
+        pyramid = _pyramids.get(fp)
+    if pyramid is not None and pyramid[0] == version:
+        return pyramid[1:]
+    forget(fp)
+    pyramid = (version,) + _build(fp, version)
+    with _lock:
+        _pyramids[fp] = pyramid
+    return pyramid[1:]
+
+
+def build_later(fp):
+    """Queues a build of the pyramid for the template at fp.
+
+    Builds run one at a time on this process's builder thread, which is
+    started by the first call, so neither the caller nor requests for other
+    templates wait for them.
+
+    """
+    _start()
+    _queue.put(fp)
+
+
+def fit_size(size, box):
+    """Returns the size Image.thumbnail(...) scales an image of size down to
+    so that it fits in box.
+
+    >>> fit_size((1177, 479), (128, 128))
+    (128, 52)
+    >>> fit_size((1023, 1211), (128, 128))
+    (108, 128)
+
+    """
+    x, y = size
+    if x > box[0]:
+        y = max(y * box[0] / x, 1)
+        x = box[0]
+    if y > box[1]:
+        x = max(x * box[1] / y, 1)
+        y = box[1]
+    return x, y
+
+
+def forget(fp):
+    """Drops this process's mappings of the pyramid for the template at fp."""
+    with _lock:
+        pyramid = _pyramids.pop(fp, None)
+    if pyramid is not None:
+        for size, rp in pyramid[2]:
+            store.forget(rp)
+
+
+def get(fp, size, fit=False, st=None):
+    """Returns the smallest level of the pyramid for the template at fp that is
+    at least size.
+
+    If fit is True, size is instead a box the template will be scaled down to
+    fit in, as Image.thumbnail(...) does (see fit_size). Returns an (image, format, mode) tuple
+    like store.get(...), or None if no level is smaller than the template. st
+    is passed on to build(...).
+
+    """
+    original, levels = build(fp, st)
+    if fit:
+        size = fit_size(original, size)
+    for level, rp in reversed(levels):
+        if level[0] >= size[0] and level[1] >= size[1]:
+            return store.load(rp)
+    return None
+
+
+def _build(fp, version):
+    im = Image.open(fp)
+    if not store.storable(im):
+        return im.size, []
+    levels = []
+    size = im.size
+    while max(size) > min_edge:
+        size = (max(size[0] / 2, 1), max(size[1] / 2, 1))
+        levels.append((size, path.join(settings.PYRAMID_DIR,
+                                       '%s.%d.raw' % (version,
+                                                      len(levels) + 1))))
+    if not path.isdir(settings.PYRAMID_DIR):
+        try:
+            os.makedirs(settings.PYRAMID_DIR)
+        except OSError:
+            # Another process created it first.
+            pass
+    # Processes that need the same pyramid wait for the first to build it.
+    with open(path.join(settings.PYRAMID_DIR, '%s.lock' % path.basename(fp)),
+              'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        store.remove_old(settings.PYRAMID_DIR, path.basename(fp),
+                         [rp for size, rp in levels])
+        source = im
+        for i, (size, rp) in enumerate(levels):
+            if path.exists(rp):
+                source = None
+                continue
+            if source is None:
+                source = store.load(levels[i - 1][1])[0]
+            source = source.resize(size, Image.ANTIALIAS)
+            store.save(rp, source, im.mode, im.format)
+    return im.size, levels
+
+
+def _run(queue):
+    while True:
+        fp = queue.get()
+        try:
+            build(fp)
+        except Exception:
+            logger.exception('Error building the pyramid for %s', fp)
+        finally:
+            queue.task_done()
+
+
+def _start():
+    # Starts the builder thread, again if this process was forked from one
+    # that had already started it.
+    global _pid, _queue, _thread
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            _queue = Queue.Queue()
+            _thread = threading.Thread(target=_run, args=(_queue,),
+                                       name='builder.pyramid')
+            _thread.daemon = True
+            _thread.start()
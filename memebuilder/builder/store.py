@@ -0,0 +1,147 @@
+import glob
+import mmap
+import os
+import thread
+import threading
+from os import path
+
+from django.conf import settings
+
+from . import lazy
+
+Image = lazy.module('PIL.Image')
+
+
+header_size = 64
+# Modes PIL can wrap around a buffer without copying, by template mode.
+modes = {'CMYK': 'CMYK', 'L': 'L', 'RGB': 'RGBX', 'RGBA': 'RGBA'}
+
+_lock = threading.Lock()
+_maps = {}
+_unsupported = object()
+
+
+def forget(key):
+    """Drops this process's mapping of a template or raw file."""
+    with _lock:
+        _maps.pop(key, None)
+
+
+def get(fp, st=None):
+    """Returns the decoded pixels of the template at fp, shared between
+    processes.
+
+    The first process to ask for a template decodes it into a raw file in
+    settings.TEMPLATE_STORE_DIR, which every process then memory-maps. Returns
+    an (image, format, mode) tuple, where image is a read-only view of the
+    mapped pixels and mode is the mode to convert image to before saving it
+    (or None if it is already in the template's mode). Returns None for
+    templates that can't be stored, such as palette images.
+
+    st is fp's os.stat result, if the caller already has it.
+
+    """
+    if st is None:
+        st = os.stat(fp)
+    rp = path.join(settings.TEMPLATE_STORE_DIR,
+                   '%s.%d.%d.raw' % (path.basename(fp), int(st.st_mtime),
+                                     st.st_size))
+    with _lock:
+        entry = _maps.get(fp)
+    if entry is None or entry[0] != rp:
+        entry = _map(rp)
+        if entry is None:
+            im = Image.open(fp)
+            if not storable(im):
+                entry = rp, _unsupported
+            else:
+                remove_old(settings.TEMPLATE_STORE_DIR, path.basename(fp), [rp])
+                save(rp, im, im.mode, im.format)
+                entry = _map(rp)
+        with _lock:
+            _maps[fp] = entry
+    if entry[1] is _unsupported:
+        return None
+    return _open(entry)
+
+
+def load(rp):
+    """Returns an (image, format, mode) tuple for the raw file rp, as get(...)
+    does, or None if rp doesn't exist.
+
+    """
+    with _lock:
+        entry = _maps.get(rp)
+    if entry is None:
+        entry = _map(rp)
+        if entry is None:
+            return None
+        with _lock:
+            _maps[rp] = entry
+    return _open(entry)
+
+
+def remove_old(dn, fn, keep):
+    """Removes raw files for other versions of fn from dn.
+
+    keep is a list of the paths of the current version's raw files.
+
+    """
+    for old in glob.glob('%s.*.raw' % path.join(dn, fn)):
+        if old not in keep:
+            try:
+                os.remove(old)
+            except OSError:
+                # Another process removed it first.
+                pass
+
+
+def save(rp, im, mode, format_):
+    """Saves im to the raw file rp, for a template in mode and format_.
+
+    rp is replaced atomically, so other processes never map a partial file.
+
+    """
+    dn = path.dirname(rp)
+    if not path.isdir(dn):
+        try:
+            os.makedirs(dn)
+        except OSError:
+            # Another process created it first.
+            pass
+    if im.mode != modes[mode]:
+        im = im.convert(modes[mode])
+    header = '%s %d %d %s' % (mode, im.size[0], im.size[1], format_)
+    tmp = '%s.%d.%d.tmp' % (rp, os.getpid(), thread.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(header_size))
+        f.write(im.tobytes())
+    os.rename(tmp, rp)
+
+
+def storable(im):
+    """Returns whether an image can be saved as a raw file."""
+    return im.mode in modes and 'transparency' not in im.info
+
+
+def _map(rp):
+    # Maps a raw file written by save(...), returning an entry for _maps, or
+    # None if it doesn't exist yet.
+    try:
+        f = open(rp, 'rb')
+    except IOError:
+        return None
+    with f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    mode, width, height, format_ = mm[:header_size].split()
+    return (rp, buffer(mm, header_size), mode, (int(width), int(height)),
+            format_)
+
+
+def _open(entry):
+    # Wraps the pixels of an entry in _maps in an image.
+    rp, data, mode, size, format_ = entry
+    im = Image.frombuffer(modes[mode], size, data, 'raw', modes[mode], 0, 1)
+    if modes[mode] == mode:
+        mode = None
+    return im, format_, mode
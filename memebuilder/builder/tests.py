@@ -1,12 +1,34 @@
+import cStringIO
+import fcntl
+import glob
 import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 from os import path
 
 import dingus
+from django import http
 from django import test
+from django.core import management
 from django.conf import settings
+from PIL import Image
 from PIL import ImageColor
+from PIL import ImageFont
 
+from . import bulk
+from . import coalesce
+from . import ingest
+from . import pyramid
+from . import store
 from . import views
+from . import warmup
+from . import watch
 
 
 class MultiValueDingus(dingus.Dingus):
@@ -86,6 +108,318 @@ class MultiValueDingus(dingus.Dingus):
         return retval
 
 
+class TestBulk(test.SimpleTestCase):
+    captions = [{'top': 'one does not simply', 'bottom': 'caption in bulk',
+                 'balign': 'right'},
+                {'top': 'one does not simply', 'middle': 'wrap twice',
+                 'malign': 'middle'}]
+
+    def setUp(self):
+        self.ImageFont = bulk.ImageFont
+        bulk.ImageFont = dingus.Dingus(
+            truetype__returns=ImageFont.load_default())
+        self.TEMPLATE_STORE_DIR = settings.TEMPLATE_STORE_DIR
+        settings.TEMPLATE_STORE_DIR = None
+        self.tmp = tempfile.mkdtemp()
+        for fn in ('a.jpg', 'b.jpg'):
+            shutil.copy(path.join(path.dirname(__file__), 'fixtures', 'test',
+                                  'business_cat.jpg'),
+                        path.join(self.tmp, fn))
+        self.templates = views.templates
+        views.templates = self.tmp
+        self.wrap = views.wrap
+        self.wraps = 0
+        def wrap(*args):
+            self.wraps += 1
+            return self.wrap(*args)
+        views.wrap = wrap
+
+    def tearDown(self):
+        bulk.ImageFont = self.ImageFont
+        settings.TEMPLATE_STORE_DIR = self.TEMPLATE_STORE_DIR
+        shutil.rmtree(self.tmp)
+        views.templates = self.templates
+        views.wrap = self.wrap
+
+    def test_composite_archive(self):
+        for dest in ('out.zip', 'out.tar.gz'):
+            names = bulk.composite(['a.jpg'], self.captions, 'Impact', 12,
+                                   'white', path.join(self.tmp, dest))
+            self.assertEqual(names, ['a-0.jpg', 'a-1.jpg'])
+        with zipfile.ZipFile(path.join(self.tmp, 'out.zip')) as z:
+            self.assertEqual(z.namelist(), names)
+        with tarfile.open(path.join(self.tmp, 'out.tar.gz')) as t:
+            self.assertEqual(t.getnames(), names)
+
+    def test_composite_directory(self):
+        out = path.join(self.tmp, 'out')
+        names = bulk.composite(['a.jpg', 'b.jpg'], self.captions, 'Impact', 12,
+                               'white', out)
+        self.assertEqual(names, ['a-0.jpg', 'a-1.jpg', 'b-0.jpg', 'b-1.jpg'])
+        self.assertEqual(sorted(os.listdir(out)), names)
+        self.assertEqual(Image.open(path.join(out, 'b-1.jpg')).size,
+                         (128, 128))
+        # Text is only wrapped for the first template.
+        wraps, self.wraps = self.wraps, 0
+        bulk.composite(['a.jpg'], self.captions, 'Impact', 12, 'white', out)
+        self.assertEqual(self.wraps, wraps)
+
+    def test_caption_matches_paste(self):
+        im = Image.open(path.join(self.tmp, 'a.jpg')).convert('RGB')
+        compositor = bulk.Compositor('Impact', 12, 'white')
+        vectorized = compositor.caption(im, self.captions[0])
+        numpy = bulk.numpy
+        bulk.numpy = None
+        try:
+            pasted = compositor.caption(im, self.captions[0])
+        finally:
+            bulk.numpy = numpy
+        self.assertEqual(vectorized.tobytes(), pasted.tobytes())
+        self.assertNotEqual(vectorized.tobytes(), im.tobytes())
+
+    def test_caption_matches_render_caption(self):
+        ImageFont = views.ImageFont
+        views.ImageFont = bulk.ImageFont
+        try:
+            for params in self.captions:
+                data, format_ = views.render_caption(
+                    'a.jpg', dict(params, color='white', font='Impact',
+                                  size='12'))
+                out = path.join(self.tmp, 'out')
+                bulk.composite(['a.jpg'], [params], 'Impact', 12, 'white', out)
+                with open(path.join(out, 'a-0.jpg'), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+        finally:
+            views.ImageFont = ImageFont
+
+    def test_layout_shifts_by_height(self):
+        compositor = bulk.Compositor('Impact', 12, 'white')
+        params = {'bottom': 'bottom', 'middle': 'middle', 'top': 'top'}
+        short = compositor.layout((128, 100), params)
+        tall = compositor.layout((128, 300), params)
+        self.assertEqual([pos[1] for line, pos in tall],
+                         [short[0][1][1], short[1][1][1] + 100,
+                          short[2][1][1] + 200])
+        self.assertEqual(self.wraps, 3)
+
+
+class CountingEvent(threading._Event):
+    """An Event that counts the calls to wait(...)."""
+    def __init__(self):
+        threading._Event.__init__(self)
+        self.lock = threading.Lock()
+        self.waits = 0
+
+    def wait(self, timeout=None):
+        with self.lock:
+            self.waits += 1
+        return threading._Event.wait(self, timeout)
+
+
+class CountingCall(coalesce._Call):
+    """A render in progress that counts the threads waiting on it."""
+    def __init__(self):
+        super(CountingCall, self).__init__()
+        self.done = CountingEvent()
+
+
+class TestCoalesce(test.SimpleTestCase):
+    def setUp(self):
+        self.COALESCE_DIR = settings.COALESCE_DIR
+        settings.COALESCE_DIR = None
+        self._Call = coalesce._Call
+        coalesce._Call = CountingCall
+        self.renders = 0
+        self.release = threading.Event()
+
+    def tearDown(self):
+        if settings.COALESCE_DIR:
+            shutil.rmtree(settings.COALESCE_DIR)
+        settings.COALESCE_DIR = self.COALESCE_DIR
+        coalesce._Call = self._Call
+
+    def render(self):
+        self.renders += 1
+        self.release.wait()
+        return 'data', 'JPEG'
+
+    def start(self, n, results):
+        threads = [threading.Thread(
+                       target=lambda: results.append(coalesce.do('k',
+                                                                 self.render)))
+                   for i in xrange(n)]
+        for t in threads:
+            t.start()
+        return threads
+
+    def wait_for(self, condition):
+        # Polls until condition() is true, so threads are known to have
+        # reached a point before the test moves on.
+        deadline = time.time() + 10
+        while not condition():
+            assert time.time() < deadline, 'Timed out waiting for threads.'
+            time.sleep(0.01)
+
+    def wait_for_followers(self, n):
+        # Waits until n threads are waiting for the render of 'k' in progress.
+        self.wait_for(lambda: 'k' in coalesce._calls and
+                              coalesce._calls['k'].done.waits == n)
+
+    def wait_for_file(self, fn):
+        self.wait_for(lambda: path.exists(path.join(settings.COALESCE_DIR,
+                                                    fn)))
+
+    def test_do(self):
+        self.release.set()
+        self.assertEqual(coalesce.do('k', self.render), ('data', 'JPEG'))
+        self.assertEqual(coalesce.do('k', self.render), ('data', 'JPEG'))
+        self.assertEqual(self.renders, 2)
+
+    def test_do_coalesces_threads(self):
+        results = []
+        threads = self.start(5, results)
+        self.wait_for_followers(4)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(results, [('data', 'JPEG')] * 5)
+
+    def test_do_shares_errors(self):
+        def render():
+            self.release.wait()
+            raise IOError('broken')
+        errors = []
+        def target():
+            try:
+                coalesce.do('k', render)
+            except IOError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=target) for i in xrange(3)]
+        for t in threads:
+            t.start()
+        self.wait_for_followers(2)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(set(errors)), 1)
+
+    def test_do_shared_renders(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        self.release.set()
+        for key in ('j', 'k', 'k'):
+            self.assertEqual(coalesce.do(key, self.render), ('data', 'JPEG'))
+        self.assertEqual(self.renders, 3)
+        # Nothing is left behind when nobody waited.
+        self.assertEqual(os.listdir(settings.COALESCE_DIR), [])
+
+    def test_do_shared_writes_for_waiters(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        self.release.set()
+        open(path.join(settings.COALESCE_DIR, 'k.wait'), 'w').close()
+        self.assertEqual(coalesce.do('k', self.render), ('data', 'JPEG'))
+        with open(path.join(settings.COALESCE_DIR, 'k.out')) as f:
+            self.assertEqual(f.read(), 'JPEG\ndata')
+        assert not path.exists(path.join(settings.COALESCE_DIR, 'k.wait'))
+
+    def test_do_shared_waits_for_other_process(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        # Pretend to be another process holding the lock for 'k'.
+        lock = open(path.join(settings.COALESCE_DIR, 'k.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        results = []
+        threads = self.start(1, results)
+        self.wait_for_file('k.wait')
+        with open(path.join(settings.COALESCE_DIR, 'k.out'), 'w') as f:
+            f.write('PNG\nother')
+        lock.close()
+        self.release.set()
+        threads[0].join()
+        self.assertEqual(self.renders, 0)
+        self.assertEqual(results, [('other', 'PNG')])
+
+    def test_do_shared_ignores_stale_results(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        lock = open(path.join(settings.COALESCE_DIR, 'k.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        results = []
+        threads = self.start(1, results)
+        self.wait_for_file('k.wait')
+        out = path.join(settings.COALESCE_DIR, 'k.out')
+        with open(out, 'w') as f:
+            f.write('PNG\nother')
+        os.utime(out, (0, 0))
+        lock.close()
+        self.release.set()
+        threads[0].join()
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(results, [('data', 'JPEG')])
+
+    def test_key_for(self):
+        self.assertEqual(coalesce.key_for('thumbnail', 'a.jpg', '1', '2'),
+                         coalesce.key_for('thumbnail', 'a.jpg', '1', '2'))
+        self.assertNotEqual(coalesce.key_for('thumbnail', 'a.jpg', '1', '2'),
+                            coalesce.key_for('thumbnail', 'a.jpg', '2', '1'))
+
+    def test_prune(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        old = path.join(settings.COALESCE_DIR, 'old.out')
+        new = path.join(settings.COALESCE_DIR, 'new.out')
+        open(old, 'w').close()
+        open(new, 'w').close()
+        os.utime(old, (0, 0))
+        coalesce.prune()
+        self.assertEqual(os.listdir(settings.COALESCE_DIR), ['new.out'])
+
+    def test_prune_keeps_held_locks(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        held = path.join(settings.COALESCE_DIR, 'k.lock')
+        free = path.join(settings.COALESCE_DIR, 'free.lock')
+        lock = open(held, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        open(free, 'w').close()
+        os.utime(held, (0, 0))
+        os.utime(free, (0, 0))
+        coalesce.prune()
+        self.assertEqual(os.listdir(settings.COALESCE_DIR), ['k.lock'])
+        results = []
+        threads = self.start(1, results)
+        self.wait_for_file('k.wait')
+        with open(path.join(settings.COALESCE_DIR, 'k.out'), 'w') as f:
+            f.write('PNG\nother')
+        lock.close()
+        self.release.set()
+        threads[0].join()
+        self.assertEqual(self.renders, 0)
+        self.assertEqual(results, [('other', 'PNG')])
+
+    def test_do_shared_locks_replaced_lock_file(self):
+        settings.COALESCE_DIR = tempfile.mkdtemp()
+        fp = path.join(settings.COALESCE_DIR, 'k.lock')
+        old = open(fp, 'w')
+        fcntl.flock(old, fcntl.LOCK_EX)
+        results = []
+        threads = self.start(1, results)
+        self.wait_for_file('k.wait')
+        # Pretend the lock file was pruned and another process locked the new
+        # one before the waiting thread woke up.
+        os.remove(fp)
+        os.remove(path.join(settings.COALESCE_DIR, 'k.wait'))
+        new = open(fp, 'w')
+        fcntl.flock(new, fcntl.LOCK_EX)
+        old.close()
+        # The thread creates k.wait again once it waits for the new lock file.
+        self.wait_for_file('k.wait')
+        with open(path.join(settings.COALESCE_DIR, 'k.out'), 'w') as f:
+            f.write('PNG\nother')
+        new.close()
+        self.release.set()
+        threads[0].join()
+        self.assertEqual(self.renders, 0)
+        self.assertEqual(results, [('other', 'PNG')])
+
+
 class TestGetColors(test.SimpleTestCase):
     def setUp(self):
         self.colormap = ImageColor.colormap
@@ -138,6 +472,14 @@ class TestViews(test.TestCase):
         self.STATICFILES_DIRS = settings.STATICFILES_DIRS
         settings.STATICFILES_DIRS = (path.join(path.dirname(__file__),
                                                'fixtures', 'test'),)
+        self.COALESCE_DIR = settings.COALESCE_DIR
+        settings.COALESCE_DIR = None
+        self.TEMPLATE_STORE_DIR = settings.TEMPLATE_STORE_DIR
+        settings.TEMPLATE_STORE_DIR = None
+        self.PYRAMID_DIR = settings.PYRAMID_DIR
+        settings.PYRAMID_DIR = None
+        self.WATCH_INTERVAL = settings.WATCH_INTERVAL
+        settings.WATCH_INTERVAL = None
 
     def tearDown(self):
         views.Image = self.Image
@@ -146,6 +488,10 @@ class TestViews(test.TestCase):
         views.balance = self.balance
         views.wrap = self.wrap
         settings.STATICFILES_DIRS = self.STATICFILES_DIRS
+        settings.COALESCE_DIR = self.COALESCE_DIR
+        settings.TEMPLATE_STORE_DIR = self.TEMPLATE_STORE_DIR
+        settings.PYRAMID_DIR = self.PYRAMID_DIR
+        settings.WATCH_INTERVAL = self.WATCH_INTERVAL
 
     def test_caption_get(self):
         response = self.client.get('/caption/business_cat.jpg/')
@@ -218,6 +564,359 @@ class TestViews(test.TestCase):
         self.assertEqual(views.Image.open().calls[1][0], 'save')
 
 
+class TestIngest(test.SimpleTestCase):
+    def setUp(self):
+        self.PYRAMID_DIR = settings.PYRAMID_DIR
+        settings.PYRAMID_DIR = tempfile.mkdtemp()
+        self.WATCH_INTERVAL = settings.WATCH_INTERVAL
+        settings.WATCH_INTERVAL = None
+        self.templates = views.templates
+        views.templates = tempfile.mkdtemp()
+        shutil.copy(path.join(path.dirname(__file__), 'fixtures', 'test',
+                              'business_cat.jpg'),
+                    views.templates)
+        self.tmp = tempfile.mkdtemp()
+        cat = Image.open(path.join(views.templates, 'business_cat.jpg'))
+        cat.resize((2400, 1600)).convert('CMYK').save(
+            path.join(self.tmp, 'Big Cat!.jpg'), quality=100)
+        cat.save(path.join(self.tmp, 'same_cat.png'))
+        Image.new('RGBA', (64, 64), (255, 0, 0, 128)).save(
+            path.join(self.tmp, 'red.png'))
+        with open(path.join(self.tmp, 'notes.txt'), 'w') as f:
+            f.write('not an image')
+
+    def tearDown(self):
+        shutil.rmtree(settings.PYRAMID_DIR)
+        shutil.rmtree(views.templates)
+        shutil.rmtree(self.tmp)
+        settings.PYRAMID_DIR = self.PYRAMID_DIR
+        settings.WATCH_INTERVAL = self.WATCH_INTERVAL
+        views.templates = self.templates
+
+    def sources(self):
+        return [path.join(self.tmp, fn) for fn in os.listdir(self.tmp)]
+
+    def test_ingest(self):
+        summary = ingest.ingest(self.sources(), 2)
+        self.assertEqual(summary['added'],
+                         [(path.join(self.tmp, 'Big Cat!.jpg'), 'big_cat.jpg'),
+                          (path.join(self.tmp, 'red.png'), 'red.png')])
+        self.assertEqual(summary['duplicates'],
+                         [(path.join(self.tmp, 'same_cat.png'),
+                           'business_cat.jpg')])
+        self.assertEqual([source for source, error in summary['failed']],
+                         [path.join(self.tmp, 'notes.txt')])
+        assert summary['bytes_after'] < summary['bytes_before']
+        self.assertEqual(views.list_templates(),
+                         [('Big Cat', 'big_cat.jpg'),
+                          ('Business Cat', 'business_cat.jpg'),
+                          ('Red', 'red.png')])
+
+        im = Image.open(path.join(views.templates, 'big_cat.jpg'))
+        self.assertEqual((im.format, im.mode, im.size),
+                         ('JPEG', 'RGB', (settings.INGEST_MAX_EDGE, 800)))
+        assert 'exif' not in im.info
+        im = Image.open(path.join(views.templates, 'red.png'))
+        self.assertEqual((im.format, im.mode), ('PNG', 'RGBA'))
+
+        catalog = ingest.load_catalog()
+        self.assertEqual(sorted(entry['name'] for entry in catalog.values()),
+                         ['big_cat.jpg', 'business_cat.jpg', 'red.png'])
+        self.assertEqual(len(glob.glob(path.join(settings.PYRAMID_DIR,
+                                                 'big_cat.jpg.*.raw'))),
+                         4)
+
+    def test_ingest_twice(self):
+        ingest.ingest(self.sources(), 1)
+        summary = ingest.ingest(self.sources(), 1)
+        self.assertEqual(summary['added'], [])
+        self.assertEqual(len(summary['duplicates']), 3)
+
+    def test_ingest_copy_of_large_template(self):
+        huge = path.join(views.templates, 'huge_cat.png')
+        Image.open(path.join(self.tmp, 'Big Cat!.jpg')).convert('RGB').save(
+            huge)
+        shutil.copy(huge, path.join(self.tmp, 'huge_cat_copy.png'))
+        summary = ingest.ingest([path.join(self.tmp, 'huge_cat_copy.png')], 1)
+        self.assertEqual(summary['added'], [])
+        self.assertEqual(summary['duplicates'],
+                         [(path.join(self.tmp, 'huge_cat_copy.png'),
+                           'huge_cat.png')])
+
+    def test_ingest_rotated_photo(self):
+        # A sideways photo, with a blue corner that belongs at the top right.
+        im = Image.new('RGB', (60, 40), 'red')
+        im.paste((0, 0, 255), (0, 0, 10, 10))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        im.save(path.join(self.tmp, 'phone.jpg'), exif=exif.tobytes())
+        summary = ingest.ingest([path.join(self.tmp, 'phone.jpg')], 1)
+        im = Image.open(path.join(views.templates, summary['added'][0][1]))
+        self.assertEqual(im.size, (40, 60))
+        r, g, b = im.convert('RGB').getpixel((35, 4))
+        assert b > 200 and r < 50
+        assert 'exif' not in im.info
+
+    def test_ingest_decompression_bomb(self):
+        # Big Cat (and a copy of it among the templates) is too large to open
+        # safely; the other candidates are still ingested.
+        shutil.copy(path.join(self.tmp, 'Big Cat!.jpg'),
+                    path.join(views.templates, 'huge_cat.jpg'))
+        max_image_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = 1000000
+        try:
+            summary = ingest.ingest(self.sources(), 2)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
+        self.assertEqual(summary['added'],
+                         [(path.join(self.tmp, 'red.png'), 'red.png')])
+        self.assertEqual(summary['duplicates'],
+                         [(path.join(self.tmp, 'same_cat.png'),
+                           'business_cat.jpg')])
+        self.assertEqual([source for source, error in summary['failed']],
+                         [path.join(self.tmp, 'Big Cat!.jpg'),
+                          path.join(self.tmp, 'notes.txt')])
+        self.assertEqual(sorted(entry['name']
+                                for entry in ingest.load_catalog().values()),
+                         ['business_cat.jpg', 'red.png'])
+
+    def test_ingest_removed_template(self):
+        ingest.ingest(self.sources(), 1)
+        os.remove(path.join(views.templates, 'red.png'))
+        summary = ingest.ingest([path.join(self.tmp, 'red.png')], 1)
+        self.assertEqual(summary['added'],
+                         [(path.join(self.tmp, 'red.png'), 'red.png')])
+
+    def test_command(self):
+        out = cStringIO.StringIO()
+        err = cStringIO.StringIO()
+        management.call_command('ingest', self.tmp, jobs=1, stdout=out,
+                                stderr=err)
+        assert 'Added 2 templates' in out.getvalue()
+        assert 'duplicate of business_cat.jpg' in out.getvalue()
+        assert 'notes.txt' in err.getvalue()
+
+
+class TestPyramid(test.SimpleTestCase):
+    def setUp(self):
+        self.PYRAMID_DIR = settings.PYRAMID_DIR
+        settings.PYRAMID_DIR = tempfile.mkdtemp()
+        self.TEMPLATE_STORE_DIR = settings.TEMPLATE_STORE_DIR
+        settings.TEMPLATE_STORE_DIR = None
+        self.tmp = tempfile.mkdtemp()
+        self.fp = path.join(self.tmp, 'big_cat.jpg')
+        Image.open(path.join(path.dirname(__file__), 'fixtures', 'test',
+                             'business_cat.jpg')).resize((600, 400)).save(
+                                 self.fp)
+        self.templates = views.templates
+        views.templates = self.tmp
+
+    def tearDown(self):
+        shutil.rmtree(settings.PYRAMID_DIR)
+        shutil.rmtree(self.tmp)
+        settings.PYRAMID_DIR = self.PYRAMID_DIR
+        settings.TEMPLATE_STORE_DIR = self.TEMPLATE_STORE_DIR
+        views.templates = self.templates
+        pyramid._pyramids.clear()
+
+    def test_build(self):
+        size, levels = pyramid.build(self.fp)
+        self.assertEqual(size, (600, 400))
+        self.assertEqual([level for level, rp in levels],
+                         [(300, 200), (150, 100), (75, 50)])
+        for level, rp in levels:
+            self.assertEqual(store.load(rp)[0].size, level)
+        self.assertEqual(len(glob.glob(path.join(settings.PYRAMID_DIR,
+                                                 '*.raw'))),
+                         3)
+
+    def test_build_is_incremental(self):
+        size, levels = pyramid.build(self.fp)
+        for level, rp in levels:
+            os.utime(rp, (0, 0))
+        os.remove(levels[1][1])
+        pyramid._pyramids.clear()
+        pyramid.build(self.fp)
+        self.assertEqual([os.stat(rp).st_mtime == 0 for level, rp in levels],
+                         [True, False, True])
+
+    def test_build_replaces_modified(self):
+        pyramid.build(self.fp)
+        os.utime(self.fp, (0, 0))
+        size, levels = pyramid.build(self.fp)
+        self.assertEqual(sorted(glob.glob(path.join(settings.PYRAMID_DIR,
+                                                    '*.raw'))),
+                         sorted(rp for level, rp in levels))
+
+    def test_build_small(self):
+        fp = path.join(path.dirname(__file__), 'fixtures', 'test',
+                       'business_cat.jpg')
+        self.assertEqual(pyramid.build(fp), ((128, 128), []))
+        self.assertEqual(pyramid.get(fp, (64, 64)), None)
+
+    def test_get(self):
+        self.assertEqual(pyramid.get(self.fp, (100, 60))[0].size, (150, 100))
+        self.assertEqual(pyramid.get(self.fp, (150, 101))[0].size, (300, 200))
+        self.assertEqual(pyramid.get(self.fp, (301, 200)), None)
+
+    def test_get_fit(self):
+        self.assertEqual(pyramid.get(self.fp, (128, 128), fit=True)[0].size,
+                         (150, 100))
+        self.assertEqual(pyramid.get(self.fp, (1000, 200), fit=True)[0].size,
+                         (300, 200))
+
+    def test_render_thumbnail(self):
+        data, format_ = views.render_thumbnail('big_cat.jpg')
+        with open(path.join(self.tmp, 'out.jpg'), 'wb') as f:
+            f.write(data)
+        im = Image.open(self.fp)
+        im.thumbnail(views.thumbnail_size, Image.ANTIALIAS)
+        self.assertEqual(Image.open(path.join(self.tmp, 'out.jpg')).size,
+                         im.size)
+
+    def test_render_thumbnail_odd_sizes(self):
+        # Halving these sizes rounds down, so their levels' proportions differ
+        # slightly from the template's.
+        sizes = [(1177, 479), (1023, 1211), (769, 257), (301, 901)]
+        for width, height in sizes:
+            Image.open(self.fp).resize((width, height)).save(
+                path.join(self.tmp, 'cat_%d_%d.jpg' % (width, height)))
+        for width, height in sizes:
+            fn = 'cat_%d_%d.jpg' % (width, height)
+            for box in [(128, 128), (100, 100), (300, 50)]:
+                data, format_ = views.render_thumbnail(fn, *box)
+                im = Image.open(path.join(self.tmp, fn))
+                im.thumbnail(box, Image.ANTIALIAS)
+                self.assertEqual(Image.open(cStringIO.StringIO(data)).size,
+                                 im.size)
+
+
+class TestStartup(test.TestCase):
+    def setUp(self):
+        self.COALESCE_DIR = settings.COALESCE_DIR
+        settings.COALESCE_DIR = None
+        self.PYRAMID_DIR = settings.PYRAMID_DIR
+        settings.PYRAMID_DIR = None
+        self.TEMPLATE_STORE_DIR = settings.TEMPLATE_STORE_DIR
+        settings.TEMPLATE_STORE_DIR = tempfile.mkdtemp()
+        self.WARMUP_TEMPLATES = settings.WARMUP_TEMPLATES
+        settings.WARMUP_TEMPLATES = ('business_cat.jpg',)
+        self.FONT_DIR = settings.FONT_DIR
+        settings.FONT_DIR = path.join(path.dirname(__file__), 'fixtures',
+                                      'test', 'fonts')
+        settings.FONT_DIR += path.sep
+        self.templates = views.templates
+        views.templates = path.join(path.dirname(__file__), 'fixtures', 'test')
+
+    def tearDown(self):
+        shutil.rmtree(settings.TEMPLATE_STORE_DIR)
+        settings.COALESCE_DIR = self.COALESCE_DIR
+        settings.PYRAMID_DIR = self.PYRAMID_DIR
+        settings.TEMPLATE_STORE_DIR = self.TEMPLATE_STORE_DIR
+        settings.WARMUP_TEMPLATES = self.WARMUP_TEMPLATES
+        settings.FONT_DIR = self.FONT_DIR
+        views.templates = self.templates
+
+    def test_import_is_lazy(self):
+        script = ('import sys\n'
+                  'import builder.views\n'
+                  'print "PIL.Image" in sys.modules\n')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='memebuilder.settings')
+        out = subprocess.check_output([sys.executable, '-c', script],
+                                      cwd=path.dirname(path.dirname(__file__)),
+                                      env=env)
+        self.assertEqual(out.strip(), 'False')
+
+    def test_warmup(self):
+        warmup.warmup()
+        assert path.join(views.templates, 'business_cat.jpg') in store._maps
+        # The first request uses the mapped template instead of decoding it.
+        store.Image = dingus.Dingus(frombuffer=Image.frombuffer)
+        try:
+            response = self.client.get('/thumbnail/business_cat.jpg/')
+            assert not store.Image.calls('open')
+        finally:
+            store.Image = Image
+        self.assertEqual(response.status_code, 200)
+
+    def test_warmup_missing_template(self):
+        settings.WARMUP_TEMPLATES = ('missing.jpg', 'business_cat.jpg')
+        logger = warmup.logger
+        warmup.logger = dingus.Dingus()
+        try:
+            warmup.warmup()
+            assert warmup.logger.calls('exception')
+        finally:
+            warmup.logger = logger
+        assert path.join(views.templates, 'business_cat.jpg') in store._maps
+
+
+class TestStore(test.SimpleTestCase):
+    def setUp(self):
+        self.PYRAMID_DIR = settings.PYRAMID_DIR
+        settings.PYRAMID_DIR = None
+        self.TEMPLATE_STORE_DIR = settings.TEMPLATE_STORE_DIR
+        settings.TEMPLATE_STORE_DIR = tempfile.mkdtemp()
+        self.tmp = tempfile.mkdtemp()
+        self.fp = path.join(self.tmp, 'business_cat.jpg')
+        shutil.copy(path.join(path.dirname(__file__), 'fixtures', 'test',
+                              'business_cat.jpg'),
+                    self.fp)
+        self.templates = views.templates
+        views.templates = self.tmp
+
+    def tearDown(self):
+        shutil.rmtree(settings.TEMPLATE_STORE_DIR)
+        shutil.rmtree(self.tmp)
+        settings.PYRAMID_DIR = self.PYRAMID_DIR
+        settings.TEMPLATE_STORE_DIR = self.TEMPLATE_STORE_DIR
+        views.templates = self.templates
+
+    def test_get(self):
+        im, format_, mode = store.get(self.fp)
+        self.assertEqual(format_, 'JPEG')
+        self.assertEqual(mode, 'RGB')
+        self.assertEqual(im.mode, 'RGBX')
+        assert im.readonly
+        self.assertEqual(im.convert('RGB').tobytes(),
+                         Image.open(self.fp).convert('RGB').tobytes())
+        self.assertEqual(len(os.listdir(settings.TEMPLATE_STORE_DIR)), 1)
+
+    def test_get_maps_existing(self):
+        store.get(self.fp)
+        del store._maps[self.fp]
+        store.Image = dingus.Dingus(frombuffer=Image.frombuffer)
+        try:
+            im, format_, mode = store.get(self.fp)
+            assert not store.Image.calls('open')
+        finally:
+            store.Image = Image
+        self.assertEqual(im.size, (128, 128))
+
+    def test_get_replaces_modified(self):
+        store.get(self.fp)
+        old = os.listdir(settings.TEMPLATE_STORE_DIR)
+        os.utime(self.fp, (0, 0))
+        store.get(self.fp)
+        new = os.listdir(settings.TEMPLATE_STORE_DIR)
+        self.assertEqual(len(new), 1)
+        self.assertNotEqual(old, new)
+
+    def test_get_unsupported(self):
+        Image.open(self.fp).convert('P').save(path.join(self.tmp, 'p.gif'))
+        self.assertEqual(store.get(path.join(self.tmp, 'p.gif')), None)
+        self.assertEqual(os.listdir(settings.TEMPLATE_STORE_DIR), [])
+
+    def test_render_thumbnail(self):
+        data, format_ = views.render_thumbnail('business_cat.jpg', '64', '64')
+        self.assertEqual(format_, 'JPEG')
+        with open(path.join(self.tmp, 'out.jpg'), 'wb') as f:
+            f.write(data)
+        im = Image.open(path.join(self.tmp, 'out.jpg'))
+        self.assertEqual(im.mode, 'RGB')
+        self.assertEqual(im.size, (64, 64))
+
+
 class TestUtils(test.SimpleTestCase):
     def test_balance(self):
         self.assertEqual(views.balance(([], [(0, 20), (0, 30)])),
@@ -342,3 +1041,98 @@ class TestUtils(test.SimpleTestCase):
         self.assertEqual(views.wrap((100, 100), font, 'abc', 'bottom',
                                     'left', 10),
                          (['bc', 'a'], [(10, 80), (10, 70)]))
+
+
+class TestWatch(test.SimpleTestCase):
+    def setUp(self):
+        self.PYRAMID_DIR = settings.PYRAMID_DIR
+        settings.PYRAMID_DIR = tempfile.mkdtemp()
+        self.TEMPLATE_STORE_DIR = settings.TEMPLATE_STORE_DIR
+        settings.TEMPLATE_STORE_DIR = None
+        self.tmp = tempfile.mkdtemp()
+        shutil.copy(path.join(path.dirname(__file__), 'fixtures', 'test',
+                              'business_cat.jpg'),
+                    path.join(self.tmp, 'business_cat.jpg'))
+        self.templates = views.templates
+        views.templates = self.tmp
+        self.changes = []
+        watch.listeners.append(self.listener)
+
+    def tearDown(self):
+        watch.listeners.remove(self.listener)
+        if pyramid._queue is not None:
+            pyramid._queue.join()
+        shutil.rmtree(settings.PYRAMID_DIR)
+        shutil.rmtree(self.tmp)
+        watch.poll()
+        settings.PYRAMID_DIR = self.PYRAMID_DIR
+        settings.TEMPLATE_STORE_DIR = self.TEMPLATE_STORE_DIR
+        views.templates = self.templates
+
+    def listener(self, dn, fn, st):
+        if dn == self.tmp:
+            self.changes.append((fn, st is not None))
+
+    def test_listing(self):
+        self.assertEqual(watch.listing(self.tmp).keys(), ['business_cat.jpg'])
+        assert watch._thread.is_alive()
+        shutil.copy(path.join(self.tmp, 'business_cat.jpg'),
+                    path.join(self.tmp, 'new.jpg'))
+        open(path.join(self.tmp, '.hidden'), 'w').close()
+        self.assertEqual(watch.listing(self.tmp).keys(), ['business_cat.jpg'])
+        watch.poll()
+        self.assertEqual(sorted(watch.listing(self.tmp)),
+                         ['business_cat.jpg', 'new.jpg'])
+        os.remove(path.join(self.tmp, 'business_cat.jpg'))
+        watch.poll()
+        self.assertEqual(watch.listing(self.tmp).keys(), ['new.jpg'])
+        self.assertEqual(self.changes,
+                         [('new.jpg', True), ('business_cat.jpg', False)])
+
+    def test_poll_modified(self):
+        watch.listing(self.tmp)
+        os.utime(path.join(self.tmp, 'business_cat.jpg'), (0, 0))
+        watch.poll()
+        self.assertEqual(self.changes, [('business_cat.jpg', True)])
+        self.assertEqual(
+            watch.listing(self.tmp)['business_cat.jpg'].st_mtime, 0)
+
+    def test_poll_removed_directory(self):
+        tmp = tempfile.mkdtemp()
+        watch.listing(tmp)
+        os.rmdir(tmp)
+        watch.poll()
+        assert tmp not in watch._watched
+
+    def test_views_use_listing(self):
+        self.assertEqual(views.list_templates(),
+                         [('Business Cat', 'business_cat.jpg')])
+        Image.open(path.join(self.tmp, 'business_cat.jpg')).resize(
+            (600, 400)).save(path.join(self.tmp, 'big_cat.jpg'))
+        self.assertEqual(views.list_templates(),
+                         [('Business Cat', 'business_cat.jpg')])
+        self.assertRaises(IOError, views.open_template, 'big_cat.jpg')
+        self.assertRaises(http.Http404, views.thumbnail, http.HttpRequest(),
+                          'big_cat.jpg')
+        watch.poll()
+        self.assertEqual(views.list_templates(),
+                         [('Big Cat', 'big_cat.jpg'),
+                          ('Business Cat', 'business_cat.jpg')])
+        self.assertEqual(views.get_size('big_cat.jpg'), (600, 400))
+        # The pyramid was queued to be built in the background when the
+        # template was added.
+        pyramid._queue.join()
+        assert path.join(self.tmp, 'big_cat.jpg') in pyramid._pyramids
+        self.assertEqual(len(glob.glob(path.join(settings.PYRAMID_DIR,
+                                                 'big_cat.jpg.*.raw'))),
+                         3)
+
+    def test_views_modified(self):
+        fp = path.join(self.tmp, 'business_cat.jpg')
+        self.assertEqual(views.get_size('business_cat.jpg'), (128, 128))
+        Image.open(fp).resize((64, 32)).save(fp)
+        self.assertEqual(views.get_size('business_cat.jpg'), (128, 128))
+        watch.poll()
+        self.assertEqual(views.get_size('business_cat.jpg'), (64, 32))
+        self.assertEqual(views.open_template('business_cat.jpg')[0].size,
+                         (64, 32))
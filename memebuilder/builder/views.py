@@ -1,3 +1,5 @@
+import cStringIO
+import errno
 import glob
 import os
 from os import path
@@ -6,15 +8,26 @@ from django import http
 from django import shortcuts
 from django import template
 from django.conf import settings
-from PIL import Image
-from PIL import ImageColor
-from PIL import ImageDraw
-from PIL import ImageFont
 
+from . import coalesce
+from . import lazy
+from . import pyramid
+from . import store
+from . import watch
 
+Image = lazy.module('PIL.Image')
+ImageColor = lazy.module('PIL.ImageColor')
+ImageDraw = lazy.module('PIL.ImageDraw')
+ImageFont = lazy.module('PIL.ImageFont')
+
+
+caption_fields = ('balign', 'bottom', 'color', 'font', 'height', 'malign',
+                  'middle', 'size', 'talign', 'top', 'width')
 templates = path.join(path.dirname(__file__), 'static', 'templates')
 thumbnail_size = (128, 128)
 
+_sizes = {}
+
 
 def get_colors():
     """Returns a list of valid color names from PIL.ImageColor.."""
@@ -30,7 +43,11 @@ def get_fonts():
     when the application is installed.
 
     """
-    fonts = glob.glob('%s*%s' % (settings.FONT_DIR, settings.FONT_TYPE))
+    if settings.WATCH_INTERVAL:
+        fonts = [fn for fn in watch.listing(settings.FONT_DIR)
+                 if fn.endswith(settings.FONT_TYPE)]
+    else:
+        fonts = glob.glob('%s*%s' % (settings.FONT_DIR, settings.FONT_TYPE))
     for i in xrange(len(fonts)):
         fonts[i] = fonts[i].rsplit('/', 1)[-1].split('.')[0]
     fonts.sort()
@@ -143,72 +160,72 @@ def wrap(im_size, font, text, loc, align, offset=0):
 
 
 def caption(request, fn=None):
-    """Captions an image, or renders a form to caption an image."""
+    """Captions an image, or renders a form to caption an image.
+
+    Concurrent requests for the same caption share a single render.
+
+    """
     if request.method == 'POST':
-        fp = path.join(templates, fn)
-        im = Image.open(fp)
-        format_ = im.format
-
-        if 'height' in request.POST and request.POST['height'] and \
-           'width' in request.POST and request.POST['width']:
-            im = im.resize((int(request.POST['width']),
-                            int(request.POST['height'])),
-                           Image.ANTIALIAS)
-
-        draw = ImageDraw.Draw(im)
-        font = ImageFont.truetype('%s%s%s' % (settings.FONT_DIR,
-                                              request.POST['font'],
-                                              settings.FONT_TYPE),
-                                  int(request.POST['size']))
-        lines, offsets = [], []
-        if 'top' in request.POST and request.POST['top']:
-            line, offset = wrap(im.size, font, request.POST['top'],
-                                'top', request.POST.get('talign', 'left'), 10)
-            lines += line
-            offsets += offset
-        if 'middle' in request.POST and request.POST['middle']:
-            line, offset = balance(wrap(im.size, font, request.POST['middle'],
-                                        'middle',
-                                        request.POST.get('malign', 'left')))
-            lines += line
-            offsets += offset
-        if 'bottom' in request.POST and request.POST['bottom']:
-            line, offset = wrap(im.size, font, request.POST['bottom'],
-                                'bottom', request.POST.get('balign', 'left'),
-                                10)
-            lines += line
-            offsets += offset
-        for i in xrange(len(lines)):
-            draw.text(offsets[i], lines[i], font=font,
-                      fill=request.POST['color'])
-
-        response = http.HttpResponse(mimetype='image/%s' % format_)
-        im.save(response, format_)
-        return response
+        params = dict((k, request.POST[k]) for k in caption_fields
+                      if k in request.POST)
+        key = coalesce.key_for('caption', fn, sorted(params.items()))
+        data, format_ = not_found_as_404(coalesce.do, key,
+                                         lambda: render_caption(fn, params))
+        return http.HttpResponse(data, mimetype='image/%s' % format_)
     else:
-        im = Image.open(path.join(templates, fn))
+        size = not_found_as_404(get_size, fn)
         return shortcuts.render_to_response('caption.html',
                                             {'colors': get_colors(),
                                              'default_font':
                                                  settings.FONT_DEFAULT,
                                              'fonts': get_fonts(),
-                                             'height': im.size[1],
+                                             'height': size[1],
                                              'image': fn,
                                              'name': name_for_image(fn),
-                                             'width': im.size[0],},
+                                             'width': size[0],},
                                             template.RequestContext(request))
 
 
+def encode(im, format_):
+    """Saves an image in format_, returning a (data, format) tuple."""
+    out = cStringIO.StringIO()
+    im.save(out, format_)
+    return out.getvalue(), format_
+
+
 def index(request):
     """Renders the index for the site."""
-    images = os.listdir(templates)
+    return shortcuts.render_to_response('index.html',
+                                        {'images': list_templates(),},
+                                        template.RequestContext(request))
+
+
+def get_size(fn):
+    """Returns the size of a template.
+
+    Sizes are cached while templates are watched (see stat_template).
+
+    """
+    st = stat_template(fn)
+    if st is None:
+        return Image.open(path.join(templates, fn)).size
+    key = (fn, st.st_mtime, st.st_size)
+    if key not in _sizes:
+        _sizes[key] = Image.open(path.join(templates, fn)).size
+    return _sizes[key]
+
+
+def list_templates():
+    """Returns a sorted list of (name, filename) tuples for the templates."""
+    if settings.WATCH_INTERVAL:
+        images = watch.listing(templates).keys()
+    else:
+        images = [fn for fn in os.listdir(templates) if not fn.startswith('.')]
     images.sort()
     for i in xrange(len(images)):
         name = name_for_image(images[i])
         images[i] = (name, images[i])
-    return shortcuts.render_to_response('index.html',
-                                        {'images': images,},
-                                        template.RequestContext(request))
+    return images
 
 
 def name_for_image(image):
@@ -221,17 +238,153 @@ def name_for_image(image):
     return image.split('.')[0].replace('_', ' ').title()
 
 
-def thumbnail(request, fn=None, width=None, height=None):
-    """Generates a thumbnail for a file."""
-    if fn is None:
+def not_found_as_404(f, *args):
+    """Calls f(*args), raising Http404 if it raises IOError because a template
+    doesn't exist.
+
+    """
+    try:
+        return f(*args)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
         raise http.Http404
+
+
+def open_template(fn, size=None, fit=False):
+    """Opens a template, returning an (image, format, mode) tuple.
+
+    If settings.TEMPLATE_STORE_DIR is set, image may be a read-only view of
+    pixels shared between processes (see store.get), which must be converted
+    to mode before it is saved. Otherwise, mode is None.
+
+    If size is given and settings.PYRAMID_DIR is set, image may instead be a
+    smaller level of the template's pyramid that can still be resized to size
+    (or, if fit is True, scaled to fit in size) without enlarging it. See
+    pyramid.get.
+
+    """
     fp = path.join(templates, fn)
+    st = stat_template(fn)
+    if size and settings.PYRAMID_DIR:
+        level = pyramid.get(fp, size, fit, st)
+        if level is not None:
+            return level
+    if settings.TEMPLATE_STORE_DIR:
+        stored = store.get(fp, st)
+        if stored is not None:
+            return stored
     im = Image.open(fp)
-    format_ = im.format
+    return im, im.format, None
+
+
+def render_caption(fn, params):
+    """Captions an image using the caption form's fields in params.
+
+    Returns a (data, format) tuple.
+
+    """
+    size = None
+    if params.get('height') and params.get('width'):
+        size = (int(params['width']), int(params['height']))
+    im, format_, mode = open_template(fn, size)
+
+    if size:
+        im = im.resize(size, Image.ANTIALIAS)
+    if mode:
+        im = im.convert(mode)
+
+    draw = ImageDraw.Draw(im)
+    font = ImageFont.truetype('%s%s%s' % (settings.FONT_DIR, params['font'],
+                                          settings.FONT_TYPE),
+                              int(params['size']))
+    lines, offsets = [], []
+    if params.get('top'):
+        line, offset = wrap(im.size, font, params['top'], 'top',
+                            params.get('talign', 'left'), 10)
+        lines += line
+        offsets += offset
+    if params.get('middle'):
+        line, offset = balance(wrap(im.size, font, params['middle'], 'middle',
+                                    params.get('malign', 'left')))
+        lines += line
+        offsets += offset
+    if params.get('bottom'):
+        line, offset = wrap(im.size, font, params['bottom'], 'bottom',
+                            params.get('balign', 'left'), 10)
+        lines += line
+        offsets += offset
+    for i in xrange(len(lines)):
+        draw.text(offsets[i], lines[i], font=font, fill=params['color'])
+    return encode(im, format_)
+
+
+def render_thumbnail(fn, width=None, height=None):
+    """Generates a thumbnail for a file, returning a (data, format) tuple."""
     if height and width:
-        im.thumbnail((int(width), int(height)), Image.ANTIALIAS)
+        size = (int(width), int(height))
+    else:
+        size = thumbnail_size
+    im, format_, mode = open_template(fn, size, fit=True)
+    original = get_size(fn) if settings.PYRAMID_DIR else im.size
+    if im.size == original:
+        im.thumbnail(size, Image.ANTIALIAS)
     else:
-        im.thumbnail(thumbnail_size, Image.ANTIALIAS)
-    response = http.HttpResponse(mimetype='image/%s' % format_)
-    im.save(response, format_)
-    return response
+        # im is a level of the template's pyramid, whose proportions were
+        # rounded as it was halved. Scale it to the size the template would be.
+        im = im.resize(pyramid.fit_size(original, size), Image.ANTIALIAS)
+    if mode:
+        im = im.convert(mode)
+    return encode(im, format_)
+
+
+def stat_template(fn):
+    """Returns a template's os.stat result from builder.watch's listing.
+
+    Returns None if settings.WATCH_INTERVAL is None, and raises IOError (as
+    opening a missing template does) if the template doesn't exist.
+
+    """
+    if not settings.WATCH_INTERVAL:
+        return None
+    st = watch.listing(templates).get(fn)
+    if st is None:
+        raise IOError(errno.ENOENT, 'No such template',
+                      path.join(templates, fn))
+    return st
+
+
+def template_changed(dn, fn, st):
+    """Updates caches derived from a template when builder.watch sees it change.
+
+    The template's pyramid is queued to be rebuilt in the background when it's
+    added or modified (see pyramid.build_later), so a large template doesn't
+    hold up the watcher thread or the first request for it.
+
+    """
+    if dn != templates:
+        return
+    fp = path.join(dn, fn)
+    pyramid.forget(fp)
+    store.forget(fp)
+    for key in [key for key in _sizes.keys() if key[0] == fn]:
+        _sizes.pop(key, None)
+    if st is not None and settings.PYRAMID_DIR:
+        pyramid.build_later(fp)
+
+
+def thumbnail(request, fn=None, width=None, height=None):
+    """Generates a thumbnail for a file.
+
+    Concurrent requests for the same thumbnail share a single render.
+
+    """
+    if fn is None:
+        raise http.Http404
+    key = coalesce.key_for('thumbnail', fn, width, height)
+    data, format_ = not_found_as_404(
+        coalesce.do, key, lambda: render_thumbnail(fn, width, height))
+    return http.HttpResponse(data, mimetype='image/%s' % format_)
+
+
+watch.listeners.append(template_changed)
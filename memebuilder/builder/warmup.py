@@ -0,0 +1,45 @@
+import logging
+from os import path
+
+from django.conf import settings
+from django.utils import importlib
+
+from . import pyramid
+from . import views
+
+
+chunk_size = 1 << 20
+logger = logging.getLogger(__name__)
+modules = ('PIL.Image', 'PIL.ImageColor', 'PIL.ImageDraw', 'PIL.ImageFont')
+
+
+def warmup():
+    """Prepares a new process to serve requests.
+
+    Imports PIL and its plugins, reads the fonts into the OS's disk cache, lists
+    the templates and opens each template in settings.WARMUP_TEMPLATES, which
+    also maps it into the template store and builds its pyramid. Templates
+    that can't be opened are logged and skipped. Called from memebuilder.wsgi
+    when settings.WARMUP is set.
+
+    """
+    for name in modules:
+        importlib.import_module(name)
+    views.Image.preinit()
+    for font in views.get_fonts():
+        read('%s%s%s' % (settings.FONT_DIR, font, settings.FONT_TYPE))
+    views.list_templates()
+    for fn in settings.WARMUP_TEMPLATES:
+        try:
+            views.open_template(fn)[0].load()
+            if settings.PYRAMID_DIR:
+                pyramid.build(path.join(views.templates, fn))
+        except IOError:
+            logger.exception('Error warming up template %s', fn)
+
+
+def read(fp):
+    """Reads a file, discarding its contents."""
+    with open(fp, 'rb') as f:
+        while f.read(chunk_size):
+            pass
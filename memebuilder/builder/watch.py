@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+from os import path
+
+from django.conf import settings
+
+
+listeners = []
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pid = None
+_thread = None
+_watched = {}
+
+
+def listing(dn):
+    """Returns a dict mapping the names of the files in dn to their os.stat
+    results.
+
+    The first call for a directory lists it and starts this process's watcher
+    thread, which polls every settings.WATCH_INTERVAL seconds. Later calls
+    return the watcher's latest listing without touching the filesystem.
+
+    """
+    with _lock:
+        files = _watched.get(dn)
+    if files is None:
+        files = _scan(dn)
+        with _lock:
+            _watched[dn] = files
+    _start()
+    return files
+
+
+def poll():
+    """Lists every watched directory again, notifying listeners of changes.
+
+    Each listener is called with the directory, the name of the file that was
+    added, modified or removed and its new os.stat result (None if it was
+    removed).
+
+    """
+    with _lock:
+        watched = _watched.items()
+    for dn, old in watched:
+        new = _scan(dn)
+        if not path.isdir(dn):
+            # Stop watching directories that have been removed.
+            with _lock:
+                _watched.pop(dn, None)
+        elif new != old:
+            with _lock:
+                _watched[dn] = new
+        changes = [(fn, new.get(fn)) for fn in set(old) | set(new)
+                   if _changed(old.get(fn), new.get(fn))]
+        for fn, st in sorted(changes):
+            for listener in listeners:
+                try:
+                    listener(dn, fn, st)
+                except Exception:
+                    logger.exception('Error handling a change to %s',
+                                     path.join(dn, fn))
+
+
+def _changed(old, new):
+    if old is None or new is None:
+        return old is not new
+    return (old.st_mtime, old.st_size) != (new.st_mtime, new.st_size)
+
+
+def _run():
+    global _pid
+    while settings.WATCH_INTERVAL:
+        time.sleep(settings.WATCH_INTERVAL)
+        poll()
+    # Watching was turned off. Let listing(...) start a new thread if it's
+    # turned back on.
+    with _lock:
+        _pid = None
+
+
+def _scan(dn):
+    files = {}
+    try:
+        names = os.listdir(dn)
+    except OSError:
+        return files
+    for fn in names:
+        if fn.startswith('.'):
+            continue
+        try:
+            files[fn] = os.stat(path.join(dn, fn))
+        except OSError:
+            # Removed since it was listed.
+            pass
+    return files
+
+
+def _start():
+    # Starts the watcher thread, again if this process was forked from one
+    # that had already started it.
+    global _pid, _thread
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            _thread = threading.Thread(target=_run, name='builder.watch')
+            _thread.daemon = True
+            _thread.start()
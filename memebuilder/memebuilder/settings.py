@@ -4,6 +4,43 @@ FONT_DEFAULT = 'Impact'
 FONT_DIR = '/Library/Fonts/'
 FONT_TYPE = '.ttf'
 
+# Identical renders in progress are shared between processes through lock and
+# result files in COALESCE_DIR, which should be a directory only the site's
+# user can write to (e.g., '/home/memebuilder/run/coalesce/'). When it is None,
+# renders are only shared between threads. Results are reused for at most
+# COALESCE_TTL seconds.
+COALESCE_DIR = None
+COALESCE_TTL = 10
+
+# Decoded template pixels are stored in TEMPLATE_STORE_DIR and memory-mapped
+# by every process. It should be a directory only the site's user can write to;
+# on Linux, a directory under /dev/shm created for that user keeps them in
+# memory. When it is None, templates are decoded on every request.
+TEMPLATE_STORE_DIR = None
+
+# Each template's resize pyramid (copies halved in size down to thumbnail size)
+# is stored in PYRAMID_DIR, and resizes start from the smallest copy that is
+# large enough. It should be a directory only the site's user can write to.
+# When it is None, resizes always start from the template itself.
+PYRAMID_DIR = None
+
+# Each process lists the templates and fonts once, then a background thread
+# checks them for changes every WATCH_INTERVAL seconds. Set it to None to check
+# the filesystem on every request instead.
+WATCH_INTERVAL = 2
+
+# Templates added with "manage.py ingest" are scaled down so their longest edge
+# is at most INGEST_MAX_EDGE pixels, and photos are saved as JPEGs of
+# INGEST_JPEG_QUALITY.
+INGEST_JPEG_QUALITY = 85
+INGEST_MAX_EDGE = 1200
+
+# Set WARMUP to True to import PIL, read the fonts and open WARMUP_TEMPLATES
+# (a tuple of template filenames) when a process starts, instead of during its
+# first request. See memebuilder.site for starting processes ahead of requests.
+WARMUP = False
+WARMUP_TEMPLATES = ()
+
 # Django settings for memebuilder project.
 
 DEBUG = True
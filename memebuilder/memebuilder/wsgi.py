@@ -23,6 +23,12 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "memebuilder.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Optionally load fonts and templates before the first request arrives.
+from django.conf import settings
+if settings.WARMUP:
+    from builder import warmup
+    warmup.warmup()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)